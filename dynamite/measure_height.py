@@ -10,6 +10,10 @@
 # - ignore after a jump in x > 1 ??
 # - ignore after a jump in y > beam ?
 
+import hashlib
+import multiprocessing
+import os
+
 import astropy.constants as ac
 import matplotlib.pyplot as plt
 import numpy as np
@@ -17,12 +21,10 @@ import scipy.constants as sc
 from alive_progress import alive_bar
 from numpy import ndarray
 from scipy import ndimage
-from scipy.ndimage import rotate
 from scipy.optimize import curve_fit, minimize
 from scipy.optimize import minimize
 from scipy.interpolate import interp1d
 from scipy.signal import find_peaks
-from scipy.stats import binned_statistic
 from astropy.convolution import Gaussian2DKernel, convolve, convolve_fft
 import celerite
 from celerite import terms
@@ -37,6 +39,22 @@ arcsec = np.pi / 648000
 
 class Surface:
 
+    # All the attributes are declared : they are stored in slots rather than in an instance dictionary,
+    # which gives faster attribute access in the loops over channels and inclinations
+    __slots__ = ('cube', 'sigma', 'exclude_inner_beam', 'n_cores', 'rotation_order', 'cache_rotation',
+                 'dist', 'cutout_parameters',
+                 # initial guess
+                 'iv_min', 'iv_max', 'delta_v_peaks', 'iv_peaks', 'v_peaks', 'v_syst', 'v_syst_wings',
+                 'excluded_delta_v', 'iv_syst', 'iv_syst_wings', 'PA_inner_disc', 'x_star', 'y_star', 'dRA', 'dDec',
+                 'PA', 'is_inc_positive', 'inc_sign', 'inc', 'image_size', 'disk_size', 'M0',
+                 # rotated and multi-scale cubes
+                 'x_star_rot', 'y_star_rot', 'n_scales', 'scales', 'rotated_images', 'multiscale_bmaj',
+                 'multiscale_bmin', 'multiscale_std',
+                 # isovelocity curves
+                 'n_surf', 'x_sky', 'y_sky', 'Tb', 'I', 'iv_min_surf', 'iv_max_surf', 'snr',
+                 # deprojected surface
+                 'x', 'y', 'r', 'h', 'v', 'dv', 'valid', 'h_std', 'v_std', 'T_std', 'm_star_sol', 'm_star')
+
     def __init__(self,
                  cube: None,
                  PA: float = None,
@@ -59,6 +77,9 @@ class Surface:
                  no_scales: bool = False,
                  scales = None,
                  only_guess: bool = False,
+                 n_cores: int = 1,
+                 rotation_order: int = 1,
+                 cache_rotation: bool = False,
                  **kwargs):
         """
         Parameters
@@ -89,6 +110,15 @@ class Surface:
             Whether to display the traces and extracted height, velocity and temperature plots
         std
             Standard deviation per channel. If None, it is calculated with numpy
+        n_cores
+            Number of processes used to extract the isovelocity curves in parallel over the channels. Default is 1
+            (serial extraction)
+        rotation_order
+            Order of the spline interpolation used to rotate the cube. Default is 1 (linear interpolation),
+            which is enough for beam-sampled data and much faster than the cubic interpolation (order 3)
+        cache_rotation
+            Save the rotated cube in a .npy file next to the fits file, and read it back in later calls with the same
+            data, PA and rotation order instead of rotating the cube again. False by default
 
         Returns
         -------
@@ -149,6 +179,9 @@ class Surface:
         self._initial_guess(num=num,std=std)
 
         self.exclude_inner_beam = exclude_inner_beam
+        self.n_cores = n_cores
+        self.rotation_order = rotation_order
+        self.cache_rotation = cache_rotation
 
         if PA is not None:
             print("Forcing PA to:", PA)
@@ -251,10 +284,15 @@ class Surface:
         std = self.cube.std
         print("Estimated std per channel is : ", std, self.cube.unit)
 
-        # Image cube with no NaN
+        # We work in single precision with a C-contiguous cube
+        if self.cube.image.dtype != np.float32 or not self.cube.image.flags.c_contiguous:
+            self.cube.image = np.ascontiguousarray(self.cube.image, dtype=np.float32)
+
+        # Image cube with no NaN, done once and in place for the whole cube :
+        # the rotated and multi-scale cubes built from it do not need to be cleaned again
         if np.isnan(np.max(self.cube.image)):
             print("Forcing NaNs to 0")
-            self.cube.image = np.nan_to_num(self.cube.image[:,:,:])
+            np.nan_to_num(self.cube.image, copy=False)
         image = self.cube.image
 
 
@@ -287,7 +325,8 @@ class Surface:
         # We have at least 0.5km/s between peaks
         dx = np.maximum(4,int(0.25/dv))
 
-        iv_peaks = search_maxima(profile, height=10*profile_rms, dx=dx, prominence=0.05*np.max(profile))
+        # we only need the 2 brightest peaks, and to know if there are more
+        iv_peaks = search_maxima(profile, height=10*profile_rms, dx=dx, prominence=0.05*np.max(profile), n_max=3)
 
         plt.figure(num+1)
         plt.clf()
@@ -515,6 +554,17 @@ class Surface:
 
     def _rotate_cube(self):
 
+        # Rotation angle in [-180,180[
+        angle_deg = (self.PA - self.inc_sign * 90.0 + 180.) % 360. - 180.
+
+        # The rotation would move the corners of the image by less than 0.01 pixel : no need to rotate the cube
+        ny, nx = self.cube.image.shape[1:3]
+        if np.deg2rad(np.abs(angle_deg)) * np.hypot(nx, ny)/2 < 0.01:
+            print("Cube is already aligned, skipping rotation")
+            self.x_star_rot = self.x_star
+            self.y_star_rot = self.y_star
+            return
+
         # Rotate star position
         angle = np.deg2rad(self.PA - self.inc_sign * 90.0)
         center = (np.array(self.cube.image.shape[1:3])-1)/2.
@@ -523,11 +573,35 @@ class Surface:
         self.x_star_rot = center[0] + dx * np.cos(angle) + dy * np.sin(angle)
         self.y_star_rot = center[1] - dx * np.sin(angle) + dy * np.cos(angle)
 
+        # The rotated cube is cached on disk, using a hash of the data to rotate
+        if self.cache_rotation:
+            key = hashlib.sha1(np.ascontiguousarray(self.cube.image[self.iv_min:self.iv_max,:,:])).hexdigest()[:16]
+            root, ext = os.path.splitext(self.cube.filename)
+            if ext.lower() == ".gz": # eg cube.fits.gz
+                root = os.path.splitext(root)[0]
+            cache_file = root + "_rotated_{}_PA={:.4f}_order={}.npy".format(key, round(self.PA - self.inc_sign * 90.0, 4), self.rotation_order)
+            if os.path.abspath(cache_file) == os.path.abspath(self.cube.filename):
+                raise ValueError("Cache file for the rotated cube would overwrite "+self.cube.filename)
+            if os.path.isfile(cache_file):
+                print("Reading rotated cube from", cache_file)
+                self.cube.image[self.iv_min:self.iv_max,:,:] = np.load(cache_file)
+                return
+
+        # Rotation matrix and offset of scipy.ndimage.rotate(reshape=False), computed once for all the channels.
+        # Each channel is rotated with a 2D affine transform, written directly in the cube
+        matrix = np.array([[np.cos(angle), np.sin(angle)],
+                           [-np.sin(angle), np.cos(angle)]])
+        offset = center - matrix @ center
         with alive_bar(int(self.iv_max-self.iv_min), title="Rotating cube") as bar:
             for iv in range(self.iv_min,self.iv_max):
-                self.cube.image[iv,:,:] = np.array(rotate(self.cube.image[iv,:,:], self.PA - self.inc_sign * 90.0, reshape=False))
+                ndimage.affine_transform(self.cube.image[iv,:,:].copy(), matrix, offset=offset, order=self.rotation_order,
+                                         prefilter=self.rotation_order > 1, output=self.cube.image[iv,:,:])
                 bar()
 
+        if self.cache_rotation:
+            print("Saving rotated cube to", cache_file)
+            np.save(cache_file, self.cube.image[self.iv_min:self.iv_max,:,:])
+
         return
 
     def _get_image_size(self,num=0):
@@ -629,10 +703,36 @@ class Surface:
         self.Tb = np.zeros([ns,nv,nx,2])
         self.I = np.zeros([ns,nv,nx,2])
 
+        channels = [(iv,iscale) for iv in range(self.iv_min,self.iv_max) for iscale in range(self.n_scales)]
+
+        n_cores = self.n_cores
+        if n_cores > 1 and "fork" not in multiprocessing.get_all_start_methods():
+            print("*** WARNING: parallel extraction needs the 'fork' start method, not available on this platform: using 1 core")
+            n_cores = 1
+
         # Loop over the channels
-        with alive_bar(int(self.iv_max-self.iv_min), title="Extracting isovelocity curves") as bar:
-            for iv in range(self.iv_min,self.iv_max):
-                for iscale in range(self.n_scales):
+        if n_cores > 1:
+            # Channels are independent : the worker processes are forked so they inherit the surface
+            # (and the rotated cube) without pickling it, and only send back the extracted curves.
+            # The pool is created before the progress bar, so no refresh thread is running when we fork
+            global _worker_surface
+            _worker_surface = self
+            try:
+                with multiprocessing.get_context("fork").Pool(n_cores) as pool:
+                    results = pool.imap_unordered(_extract_isovelocity_worker, channels)
+                    with alive_bar(len(channels), title="Extracting isovelocity curves") as bar:
+                        for iv, iscale, n, x, y, Tb, I in results:
+                            self.n_surf[iscale,iv] = n
+                            self.x_sky[iscale,iv,:n] = x
+                            self.y_sky[iscale,iv,:n,:] = y
+                            self.Tb[iscale,iv,:n,:] = Tb
+                            self.I[iscale,iv,:n,:] = I
+                            bar()
+            finally:
+                _worker_surface = None
+        else:
+            with alive_bar(len(channels), title="Extracting isovelocity curves") as bar:
+                for iv, iscale in channels:
                     self._extract_isovelocity_1channel(iv,iscale)
                     #self._refine_isovelocity_1channel(iv,iscale=iscale)
                     bar()
@@ -722,6 +822,7 @@ class Surface:
 
         # Setting up arrays in each channel map
         in_surface = np.full(nx,False)
+        detected = np.full(nx,False) # at least 2 maxima found
         j_surf = np.zeros([nx,2], dtype=int)
         j_surf_exact = np.zeros([nx,2])
         T_surf = np.zeros([nx,2])
@@ -734,18 +835,29 @@ class Surface:
         else:
             i1=int(np.floor(self.x_star_rot))+2
             i2=nx
+        i2 = max(i2, i1) # we slice im below : a negative i2 must not index from the end
+
+        # Vectorised pre-selection of the columns : a maximum returned by find_peaks is above the threshold
+        # and starts with a rising edge, so columns with less than 2 rising edges above the threshold
+        # cannot contain a surface and we skip them without calling search_maxima
+        threshold = self.sigma*std
+        # vertical profiles are stored as contiguous rows, instead of strided columns of im
+        profiles = np.ascontiguousarray(im[:,i1:i2].T)
+        rising_edge = (profiles[:,1:-1] > profiles[:,:-2]) & (profiles[:,1:-1] >= threshold)
+        n_candidates = np.count_nonzero(rising_edge, axis=1)
 
         # Loop over the pixels along the x-axis to find surface
-        for i in range(i1,i2):
-            vert_profile = im[:,i]
+        for i in i1 + np.flatnonzero(n_candidates > 1):
+            vert_profile = profiles[i-i1,:]
             # find the maxima in each vertical cut, at signal above X sigma
             # ignore maxima not separated by at least a beam
             # maxima are ordered by decarasing flux
-            j_max = search_maxima(vert_profile, height=self.sigma*std, dx=bmaj/self.cube.pixelscale,
+            j_max = search_maxima(vert_profile, height=threshold, dx=bmaj/self.cube.pixelscale,
                                   prominence=2*std)
 
             if j_max.size>1:  # We need at least 2 maxima to locate the surface
                 in_surface[i] = True
+                detected[i] = True
 
                 # indices of the near [0] and far [1] sides of upper surface
                 j_surf[i,:] = np.sort(j_max[:2])
@@ -767,34 +879,28 @@ class Surface:
                         # the average of the top surfaces cannot be below the star
                         in_surface[i] = False
 
-                #-- We find a spatial quadratic to refine position of maxima (like bettermoment does in velocity)
-                if quadratic_fit:
-                    for k in range(2):
-                        j = j_surf[i,k]
-
-                        f_max = im[j,i]
-                        f_minus = im[j-1,i]
-                        f_plus = im[j+1,i]
-
-                        # Work out the polynomial coefficients
-                        a0 = 13. * f_max / 12. - (f_plus + f_minus) / 24.
-                        a1 = 0.5 * (f_plus - f_minus)
-                        a2 = 0.5 * (f_plus + f_minus - 2*f_max)
-
-                        # Compute the maximum of the quadratic
-                        y_max = j - 0.5 * a1 / a2
-                        f_max = a0 - 0.25 * a1**2 / a2
-
-                        # Saving the coordinates
-                        j_surf_exact[i,k] = y_max
-                        I_surf[i,k] = im[j,i] = f_max
-                else:
-                    for k in range(2):
-                        j = j_surf[i,k]
-                        j_surf_exact[i,k] = j
-                        I_surf[i,k] = im[j,i]
+        #-- We find a spatial quadratic to refine position of maxima (like bettermoment does in velocity)
+        # vectorised over all the columns with detected maxima and both sides at once
+        cols = np.flatnonzero(detected)[:,np.newaxis]
+        j = j_surf[detected,:]
+        f_max = im[j,cols]
+        if quadratic_fit:
+            f_minus = im[j-1,cols]
+            f_plus = im[j+1,cols]
+
+            # Work out the polynomial coefficients
+            a0 = 13. * f_max / 12. - (f_plus + f_minus) / 24.
+            a1 = 0.5 * (f_plus - f_minus)
+            a2 = 0.5 * (f_plus + f_minus - 2*f_max)
+
+            # Compute the maximum of the quadratic and save the coordinates
+            j_surf_exact[detected,:] = j - 0.5 * a1 / a2
+            I_surf[detected,:] = im[j,cols] = a0 - 0.25 * a1**2 / a2
+        else:
+            j_surf_exact[detected,:] = j
+            I_surf[detected,:] = f_max
 
-                T_surf[i,k] = self.cube._Jybeam_to_Tb(I_surf[i,k]) # Converting to Tb (currently assuming the cube is in Jy/beam)
+        T_surf[detected,1] = self.cube._Jybeam_to_Tb(I_surf[detected,1]) # Converting to Tb (currently assuming the cube is in Jy/beam)
 
         #-- Now we try to clean out a bit the surfaces we have extracted
 
@@ -809,26 +915,32 @@ class Surface:
 
         if clean_method2:
             if np.any(in_surface):
+                # Both passes only work on the points of the surface
                 x1 = x[in_surface]
+                j1 = j_surf_exact[in_surface,:]
 
-                y1 = np.mean(j_surf_exact[in_surface,:],axis=1)
+                y1 = np.mean(j1,axis=1)
 
                 if len(x1) > 2:
-                    P = np.polyfit(x1,y1,1)
+                    P = _linfit(x1,y1)
 
                     # x_plot = np.array([0,nx])
                     # plt.plot(x_plot, P[1] + P[0]*x_plot)
 
-                    #in_surface_tmp = in_surface &  (j_surf_exact[:,0] < (P[1] + P[0]*x)) # test only front surface
-                    in_surface_tmp = in_surface & (j_surf_exact[:,0] < (P[1] + P[0]*x)) & (j_surf_exact[:,1] > (P[1] + P[0]*x))
+                    y_fit = P[1] + P[0]*x1
+                    #ok = j1[:,0] < y_fit # test only front surface
+                    ok = (j1[:,0] < y_fit) & (j1[:,1] > y_fit)
 
                     # We remove the weird point and reddo the fit again to ensure the slope we use is not too bad
-                    x1 = x[in_surface_tmp]
-                    y1 = np.mean(j_surf_exact[in_surface_tmp,:],axis=1)
-                    P = np.polyfit(x1,y1,1)
+                    if np.count_nonzero(ok) > 1:
+                        P = _linfit(x1[ok],y1[ok])
 
-                    #in_surface = in_surface &  (j_surf_exact[:,0] < (P[1] + P[0]*x)) # test only front surface
-                    in_surface = in_surface & (j_surf_exact[:,0] < (P[1] + P[0]*x)) & (j_surf_exact[:,1] > (P[1] + P[0]*x))
+                        y_fit = P[1] + P[0]*x1
+                        #in_surface[in_surface] = j1[:,0] < y_fit # test only front surface
+                        in_surface[in_surface] = (j1[:,0] < y_fit) & (j1[:,1] > y_fit)
+                    else:
+                        # not enough points left to fit a line : we discard the channel
+                        in_surface[:] = False
 
                     #-- test if we have points on both side of the star
                     # - remove side with the less points
@@ -938,21 +1050,39 @@ class Surface:
 
 
         #-- Computing the radius and height for each point
-        y_f = self.y_sky[:,:,:,1] - self.y_star_rot   # far side, y[channel number, x index]
-        y_n = self.y_sky[:,:,:,0] - self.y_star_rot   # near side
-        y_c = 0.5 * (y_f + y_n)
-        #y_c = np.ma.masked_array(y_c,mask).compressed()
-
-        x = self.x_sky[:,:,:] - self.x_star_rot
+        # this is called many times by find_i : we work in single precision and fill pre-allocated arrays
+        # to avoid temporaries
+        shape = self.x_sky.shape
+        y_f = np.empty(shape, dtype=np.float32)
+        y_c = np.empty(shape, dtype=np.float32)
+        x = np.empty(shape, dtype=np.float32)
+        y = np.empty(shape, dtype=np.float32)
+        r = np.empty(shape, dtype=np.float32)
+        v = np.empty(shape, dtype=np.float32)
+        dv = np.empty(shape, dtype=np.float32)
+
+        np.subtract(self.y_sky[:,:,:,1], self.y_star_rot, out=y_f)   # far side, y[channel number, x index]
+        np.subtract(self.y_sky[:,:,:,0], self.y_star_rot, out=y_c)   # near side
+        np.add(y_c, y_f, out=y_c)
+        y_c *= 0.5
+
+        np.subtract(self.x_sky, self.x_star_rot, out=x)
 
         # inclination plays a role from here
-        y = (y_f - y_c) / np.cos(inc_rad)
+        np.subtract(y_f, y_c, out=y)
+        y /= np.cos(inc_rad)
 
-        r = np.hypot(x,y) # Note : does not depend on y_star
-        h = y_c / np.sin(inc_rad)
+        np.hypot(x, y, out=r) # Note : does not depend on y_star
+        h = y_c # y_c is not needed anymore, we reuse its array
+        h /= np.sin(inc_rad)
 
-        v = (self.cube.velocity[np.newaxis,:,np.newaxis] - self.v_syst) * r / (x * np.sin(inc_rad)) # does not depend on y_star
-        dv = (self.cube.velocity[np.newaxis,:,np.newaxis] - self.v_syst) * (r/r)
+        delta_v = (self.cube.velocity - self.v_syst).astype(np.float32)[np.newaxis,:,np.newaxis]
+        with np.errstate(divide="ignore", invalid="ignore"): # points with x=0 or r=0 are removed below
+            np.multiply(delta_v, r, out=v)
+            v /= x
+            v /= np.sin(inc_rad) # does not depend on y_star
+            np.divide(r, r, out=dv)
+            dv *= delta_v
 
         r *= self.cube.pixelscale
         h *= self.cube.pixelscale
@@ -971,20 +1101,19 @@ class Surface:
 
         # -- If the disc is oriented the other way
         if np.median(h[~mask]) < 0:
-            h = -h
+            np.negative(h, out=h)
 
         # -- we can now remove the points with h<0 (they correspond to values set to 0 in y)
         # and where v is not defined
         mask = mask | (h<0)
 
-        r = np.ma.masked_array(r,mask)
-        h = np.ma.masked_array(h,mask)
-        v = np.ma.masked_array(v,mask)
-        dv = np.ma.masked_array(dv,mask)
+        # We keep plain arrays and the boolean index of the valid points rather than masked arrays,
+        # data points are selected with r[valid]
+        valid = ~mask
 
         # -- If the disc rotates in the opposite direction as expected
-        if np.mean(v) < 0:
-            v = -v
+        if np.mean(v[valid]) < 0:
+            np.negative(v, out=v)
 
         # -- Todo : optimize position, inclination (is that posible without a model ?), PA (need to re-run detect surface)
         self.x = x
@@ -993,19 +1122,19 @@ class Surface:
         self.h = h
         self.v = v
         self.dv = dv
+        self.valid = valid
 
         return
 
     def compute_v_std(self,nbins=30):
 
-        r = self.r.compressed()
-        h = self.h.compressed()
-        v = self.v.compressed()
-        T = np.mean(self.Tb[:,:,:,:],axis=3).ravel()[np.invert(self.r.mask.ravel())]
+        valid = self.valid
+        r = self.r[valid]
+        h = self.h[valid]
+        v = self.v[valid]
+        T = np.mean(self.Tb[:,:,:,:],axis=3)[valid]
 
-        h_std, _, _ = binned_statistic(r,h, 'std', bins=nbins)
-        v_std, _, _ = binned_statistic(r,v, 'std', bins=nbins)
-        T_std, _, _ = binned_statistic(r,T, 'std', bins=nbins)
+        _, (h_std, v_std, T_std) = _binned_mean_std(r, [h,v,T], nbins)
 
         self.h_std = np.mean(h_std)
         self.v_std = np.mean(v_std)
@@ -1147,11 +1276,13 @@ class Surface:
         v = self.v[scales,:,:]
         dv = np.abs(self.dv[scales,:,:])
         T = np.mean(self.Tb[scales,:,:,:],axis=-1)
+        valid = self.valid[scales,:,:]
 
-        r_data = r.ravel().compressed()#[np.invert(mask.ravel())]
-        h_data = h.ravel().compressed()#[np.invert(mask.ravel())]
-        v_data = v.ravel().compressed()#[np.invert(mask.ravel())]
-        T_data = T.ravel()[np.invert(r.mask.ravel())]
+        r_data = r[valid]
+        h_data = h[valid]
+        v_data = v[valid]
+        T_data = T[valid]
+        dv_data = dv[valid]
 
         if plt.fignum_exists(num):
             plt.figure(num)
@@ -1165,10 +1296,10 @@ class Surface:
                 ax.append(fig.add_subplot(gs[i,j]))
 
         #Altitude
-        ax[0].scatter(r.ravel(),h.ravel(),alpha=0.2,s=3, c=dv.ravel(), marker='o', label = 'data', cmap="jet")
+        ax[0].scatter(r_data,h_data,alpha=0.2,s=3, c=dv_data, marker='o', label = 'data', cmap="jet")
 
-        bins, _, _ = binned_statistic(r_data,[r_data,h_data], bins=nbins)
-        std, _, _ = binned_statistic(r_data,h_data, 'std', bins=nbins)
+        bins, std = _binned_mean_std(r_data, [r_data,h_data], nbins)
+        std = std[1,:]
 
         ax[0].errorbar(bins[0,:], bins[1,:],yerr=std, ecolor="grey", fmt='o', mec='k', mfc='grey', ms=3, elinewidth=2,
                        label='Binned data')
@@ -1178,7 +1309,7 @@ class Surface:
         if plot_power_law:
             #-- fitting a power-law
             P, C = self.fit_surface_height(r0 = r0)
-            x = np.linspace(np.min(r),np.max(r),100)
+            x = np.linspace(np.min(r_data),np.max(r_data),100)
 
             print('Power law fit: z0 = {:.5f} at {:.3f}", phi = {:.5f}'.format(P[0], r0, P[1]))
 
@@ -1187,7 +1318,7 @@ class Surface:
         if plot_tapered_power_law:
             #-- fitting a power-law
             P, C = self.fit_surface_height(tapered_power_law=True, r0=r0)
-            x = np.linspace(np.min(r),np.max(r),100)
+            x = np.linspace(np.min(r_data),np.max(r_data),100)
 
             print('Power law fit: z0 = {:.5f} at {:.3f}", phi = {:.5f}, r_taper = {:.5f}, q_taper = {:.5f}'
                   .format(P[0], r0, P[1], P[2], P[3]))
@@ -1204,14 +1335,14 @@ class Surface:
 
 
         #Velocity
-        ax[1].scatter(r.ravel(),v.ravel(),alpha=0.2,s=3,c=dv.ravel(),marker='o', label='Data',cmap="jet")
+        ax[1].scatter(r_data,v_data,alpha=0.2,s=3,c=dv_data,marker='o', label='Data',cmap="jet")
 
         if v_bin_width is not None:
             nbins = int(np.nanmax(r_data)/v_bin_width)  # rounds nbins down to the nearest int
             print('We used {} bins of width {:.4f} arcsec to bin the velocity data'.format(nbins, v_bin_width))
 
-        bins, _, _ = binned_statistic(r_data, [r_data, v_data], bins=nbins)
-        std, _, _ = binned_statistic(r_data, v_data, 'std', bins=nbins)
+        bins, std = _binned_mean_std(r_data, [r_data, v_data], nbins)
+        std = std[1,:]
 
         # Generate a file with radius [au], velocity [km/s] and 1sigma dispersion [km/s] written as rows
         if dist is not None:
@@ -1240,11 +1371,11 @@ class Surface:
             ax[1].plot(x, v_mod,alpha=0.75, ls='--',color="purple", label = 'Kep model w h_func')
 
         #Temperature
-        sc = ax[2].scatter(r.ravel(),T.ravel(),alpha=0.5,s=3,c=dv.ravel(),marker='o',cmap="jet")
+        sc = ax[2].scatter(r_data,T_data,alpha=0.5,s=3,c=dv_data,marker='o',cmap="jet")
         colorbar2(sc)
 
-        bins, _, _ = binned_statistic(r_data,[r_data,T_data], bins=nbins)
-        std, _, _  = binned_statistic(r_data,T_data, 'std', bins=nbins)
+        bins, std = _binned_mean_std(r_data, [r_data,T_data], nbins)
+        std = std[1,:]
 
         ax[2].errorbar(bins[0,:], bins[1,:],yerr=std, ecolor="grey", fmt='o', mec='k', mfc='grey', ms=3, elinewidth=2)
 
@@ -1276,10 +1407,8 @@ class Surface:
         y = self.y_sky
         n_surf = self.n_surf
 
-        im = np.nan_to_num(self.rotated_images[iscale,iv-self.iv_min,:,:]) # array has been trimmed in velocity
-        # Array is rotated already
-        #if self.PA is not None:
-        #    im = np.array(rotate(im, self.PA - self.inc_sign * 90.0, reshape=False))
+        im = self.rotated_images[iscale,iv-self.iv_min,:,:] # array has been trimmed in velocity
+        # Array is rotated already, no need to rotate (and interpolate) it again for display
 
         ax.imshow(im, origin="lower", cmap='binary_r')
         ax.set_title(r'v='+"{:.2f}".format(cube.velocity[iv])+' , $\Delta$v='+"{:.2f}".format(cube.velocity[iv] - self.v_syst)+' , id:'+str(iv), color='k')
@@ -1313,10 +1442,8 @@ class Surface:
         n_surf = self.n_surf
 
         iscale=0
-        im = np.nan_to_num(self.rotated_images[iscale,iv-self.iv_min,:,:])
-        # Array is rotated already
-        #if self.PA is not None:
-        #    im = np.array(rotate(im, self.PA - self.inc_sign * 90.0, reshape=False))
+        im = self.rotated_images[iscale,iv-self.iv_min,:,:]
+        # Array is rotated already, no need to rotate (and interpolate) it again for display
 
         ax.imshow(im, origin="lower", cmap='binary_r')
         ax.set_title(r'$\Delta$v='+"{:.2f}".format(cube.velocity[iv] - self.v_syst)+' , id:'+str(iv), color='k')
@@ -1340,10 +1467,8 @@ class Surface:
         n_surf = self.n_surf
 
         iscale=0
-        im = np.nan_to_num(self.rotated_images[iscale,iv-self.iv_min,:,:])
-        # Array is rotated already
-        #if self.PA is not None:
-        #    im = np.array(rotate(im, self.PA - self.inc_sign * 90.0, reshape=False))
+        im = self.rotated_images[iscale,iv-self.iv_min,:,:]
+        # Array is rotated already, no need to rotate (and interpolate) it again for display
 
         ax0 = axs.ravel()[0]
         ax0.imshow(im, origin="lower", cmap='binary_r')
@@ -1352,7 +1477,7 @@ class Surface:
         for iscale in range(self.n_scales):
             ax = axs.ravel()[iscale+1]
 
-            im = np.nan_to_num(self.rotated_images[iscale,iv-self.iv_min,:,:])
+            im = self.rotated_images[iscale,iv-self.iv_min,:,:]
             ax.imshow(im, origin="lower", cmap='binary_r')
 
             ax.plot(x[iscale,iv,:n_surf[iscale,iv]],y[iscale,iv,:n_surf[iscale,iv],0],"o",color="red",markersize=1)
@@ -1457,10 +1582,11 @@ class Surface:
         else:
             v_model = self._keplerian_disc(m_star, dist, h_func=h_func)
 
-        v = self.v[scales,:,:].ravel().compressed()
+        valid = self.valid[scales,:,:]
+        v = self.v[scales,:,:][valid]
 
         #using 1/snr as the error on the velocity
-        v_error = 1/(np.mean(self.snr[scales,:,:,:],axis=-1).ravel()[np.invert(self.r[scales,:,:].mask.ravel())])
+        v_error = 1/(np.mean(self.snr[scales,:,:,:],axis=-1)[valid])
 
         # chi2
         chi2 = np.sum(((v - v_model)**2 / v_error**2) + np.log(2*np.pi*v_error**2))
@@ -1472,12 +1598,14 @@ class Surface:
         G = sc.G
         msun = ac.M_sun.value
 
-        r = self.r.ravel().compressed() * dist * sc.au
+        # r and h are stored in single precision : we go back to double precision before converting to m,
+        # as r**2 and (r**2 + h**2)**1.5 in SI units overflow in float32
+        r = self.r[self.valid].astype(np.float64) * dist * sc.au
 
         if h_func is not None:
-            h = h_func * dist * sc.au
+            h = np.asarray(h_func, dtype=np.float64) * dist * sc.au
         else:
-            h = self.h.ravel().compressed() * dist * sc.au
+            h = self.h[self.valid].astype(np.float64) * dist * sc.au
 
         v = np.sqrt((G*m_star*msun*r**2)/((r**2 + h**2)**(3/2)))/1000
         return v
@@ -1510,9 +1638,9 @@ class Surface:
 
         """
 
-        r = np.array(self.r.ravel().compressed())
-        h = self.h.ravel().compressed()
-        error = 1/(np.mean(self.snr[:,:,:,:],axis=-1).ravel()[np.invert(self.r.mask.ravel())])
+        r = self.r[self.valid].astype(np.float64)
+        h = self.h[self.valid].astype(np.float64)
+        error = 1/(np.mean(self.snr[:,:,:,:],axis=-1)[self.valid])
 
         if tapered_power_law:
 
@@ -1593,9 +1721,9 @@ class Surface:
 
     def fit_surface_height_gp(self):
 
-        x = np.array(self.r.ravel().compressed())
-        y = self.h.ravel().compressed()
-        yerr = 1/(np.mean(self.snr[:,:,:,:],axis=3).ravel()[np.invert(self.r.mask.ravel())])
+        x = self.r[self.valid].astype(np.float64)
+        y = self.h[self.valid].astype(np.float64)
+        yerr = 1/(np.mean(self.snr[:,:,:,:],axis=3)[self.valid])
 
         order=np.argsort(x)
         x=x[order]
@@ -1637,6 +1765,18 @@ class Surface:
         return t, mu, std
 
 
+_worker_surface = None
+
+def _extract_isovelocity_worker(channel):
+    # Extracts the isovelocity curve of 1 channel in a worker process, see Surface._extract_isovelocity
+    iv, iscale = channel
+    surface = _worker_surface
+    surface._extract_isovelocity_1channel(iv,iscale)
+    n = surface.n_surf[iscale,iv]
+    return (iv, iscale, n, surface.x_sky[iscale,iv,:n], surface.y_sky[iscale,iv,:n,:],
+            surface.Tb[iscale,iv,:n,:], surface.I[iscale,iv,:n,:])
+
+
 def search_maxima_old(y, height=None, dx=0, prominence=0):
     """
     Returns the indices of the maxima of a function
@@ -1675,7 +1815,7 @@ def search_maxima_old(y, height=None, dx=0, prominence=0):
     return i_max
 
 
-def search_maxima(y, height=None, dx=0, prominence=0):
+def search_maxima(y, height=None, dx=0, prominence=0, n_max=None):
     """
     Returns the indices of the maxima of a function
     Indices are sorted by decreasing values of the maxima
@@ -1684,17 +1824,69 @@ def search_maxima(y, height=None, dx=0, prominence=0):
          y : array where to search for maxima
          threshold : minimum value of y for a maximum to be detected
          dx : minimum spacing between maxima [in pixel]
+         n_max : if provided, only the n_max highest maxima are returned
     """
 
      # find local maxima
     i_max, _ = find_peaks(y, distance = dx, width = 0.5*dx, height = height, prominence = prominence)
 
+    # Only keep the n_max highest peaks, with a partial sort, before sorting them
+    if n_max is not None and i_max.size > n_max:
+        i_max = i_max[np.argpartition(-y[i_max], n_max-1)[:n_max]]
+
     # Sort the peaks by height
     i_max = i_max[np.argsort(y[i_max])][::-1]
 
     return i_max
 
 
+def _linfit(x, y):
+    """
+    Returns the slope and intercept of the least-square linear fit of y(x), ie the same as np.polyfit(x,y,1),
+    using the closed form solution instead of a generic least-square solver
+
+    Args:
+         x, y : 1D arrays of points to fit
+    """
+
+    x_mean = np.mean(x)
+    y_mean = np.mean(y)
+    dx = x - x_mean
+    slope = (dx @ (y - y_mean)) / (dx @ dx)
+
+    return slope, y_mean - slope * x_mean
+
+
+def _binned_mean_std(x, values, nbins):
+    """
+    Returns the mean and standard deviation of several quantities in nbins regular bins of x, as
+    binned_statistic would do with 'mean' and 'std', but the bin of each point is only computed once
+
+    Args:
+         x : array used to define the bins
+         values : list of arrays with the same shape as x
+         nbins : number of bins between the min and max of x
+    """
+
+    x_min, x_max = np.min(x), np.max(x)
+    if x_min == x_max: # same as binned_statistic : the range is widened when x is constant
+        x_min -= 0.5
+        x_max += 0.5
+    edges = np.linspace(x_min, x_max, nbins+1)
+    idx = np.clip(np.searchsorted(edges, x, side="right") - 1, 0, nbins-1) # last bin includes the upper edge
+    n = np.bincount(idx, minlength=nbins)
+
+    values = np.atleast_2d(values)
+    mean = np.empty((values.shape[0],nbins))
+    std = np.empty((values.shape[0],nbins))
+    with np.errstate(invalid="ignore"): # empty bins are set to NaN
+        for k, y in enumerate(values):
+            mean[k,:] = np.bincount(idx, weights=y, minlength=nbins) / n
+            std[k,:] = np.sqrt(np.bincount(idx, weights=(y - mean[k,idx])**2, minlength=nbins) / n)
+
+    return mean, std
+
+
 def Gaussian_p_cst(x, C, A, x0, sigma):
     """" Gaussian + constant function """
     return C + A * np.exp(-(x - x0) ** 2 / (2 * sigma ** 2))